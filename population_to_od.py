@@ -1,12 +1,40 @@
 from lxml import etree as ET # Usando lxml para melhor desempenho
-from math import hypot
 import sys
 import argparse
-import numpy as np # Necessário para scipy.spatial.KDTree
-from scipy.spatial import KDTree # Para busca otimizada de nós próximos
+import queue
+import threading
+from array import array
+import numpy as np # Necessário para scipy.spatial.cKDTree
+from scipy.spatial import cKDTree # Para busca otimizada de nós próximos
 
-# --- Funções Auxiliares (time_to_seconds, find_outgoing_link) ---
-# (find_closest_node será substituída pela lógica da KDTree)
+# Tipos de item de um plano nos arrays SoA de process_population
+ITEM_ACTIVITY = 0
+ITEM_LEG = 1
+NAN = float('nan')
+
+# Número de itens de plano (atividades + pernas) por lote do pipeline (~50 mil viagens)
+PLAN_ITEMS_PER_BATCH = 200_000
+# Lotes em espera entre as etapas do pipeline e marcador de fim
+PIPELINE_QUEUE_SIZE = 4
+PIPELINE_END = object()
+# Tamanho das folhas da KD-Tree: folhas maiores favorecem a varredura linear em 2D
+KDTREE_LEAF_SIZE = 32
+# Tamanho máximo e mínimo da amostra, intervalo mínimo entre pontos amostrados e percentil
+# usados para estimar o raio máximo de busca na KD-Tree
+DISTANCE_BOUND_SAMPLE_SIZE = 10_000
+DISTANCE_BOUND_MIN_SAMPLE_SIZE = 100
+DISTANCE_BOUND_MIN_STRIDE = 10
+DISTANCE_BOUND_PERCENTILE = 99
+# Número de viagens acumuladas antes de cada escrita e tamanho do buffer do arquivo de saída
+TRIPS_PER_WRITE = 8192
+OUTPUT_BUFFER_SIZE = 1 << 20
+# Linha de viagem do trips.xml: (número da viagem, origem, destino, link de origem, início em segundos)
+TRIP_XML_TEMPLATE = (
+    b'  <trip name="t%d" origin="%s" destination="%s" link_origin="%s" count="1" '
+    b'start="%d" mode="car" digital_rails_capable="false"/>\n'
+)
+
+# --- Funções Auxiliares (time_to_seconds, times_to_seconds, find_outgoing_link) ---
 def time_to_seconds(time_str):
     """Converte uma string de tempo HH:MM:SS ou HH:MM para segundos desde a meia-noite."""
     if not time_str:
@@ -21,11 +49,87 @@ def time_to_seconds(time_str):
     except ValueError:
         return None
 
+def times_to_seconds(time_strs):
+    """
+    Versão vetorizada de time_to_seconds para uma lista de strings de tempo.
+    Retorna (segundos, válidos): um array int64 e a máscara das entradas convertidas.
+    Strings no formato fixo HH:MM:SS são convertidas com NumPy; as demais usam time_to_seconds.
+    """
+    n = len(time_strs)
+    seconds = np.zeros(n, dtype=np.int64)
+    valid = np.zeros(n, dtype=bool)
+    if n == 0:
+        return seconds, valid
+
+    time_array = np.array([t or '' for t in time_strs], dtype=str)
+    width = time_array.dtype.itemsize // 4
+    fixed_width = np.zeros(n, dtype=bool)
+    if width >= 8:
+        # Cada caractere vira um código Unicode (uint32) em uma matriz n x width
+        chars = time_array.view(np.uint32).reshape(n, width)
+        digits = chars[:, [0, 1, 3, 4, 6, 7]].astype(np.int64) - ord('0')
+        fixed_width = (
+            (np.char.str_len(time_array) == 8)
+            & (chars[:, 2] == ord(':')) & (chars[:, 5] == ord(':'))
+            & ((digits >= 0) & (digits <= 9)).all(axis=1)
+        )
+        seconds = ((digits[:, 0] * 10 + digits[:, 1]) * 3600
+                   + (digits[:, 2] * 10 + digits[:, 3]) * 60
+                   + digits[:, 4] * 10 + digits[:, 5])
+        seconds[~fixed_width] = 0
+        valid[fixed_width] = True
+
+    # Caminho escalar para formatos fora do padrão fixo (HH:MM, horas com 3 dígitos, etc.)
+    for i in np.flatnonzero(~fixed_width):
+        value = time_to_seconds(time_strs[i])
+        if value is not None:
+            seconds[i] = value
+            valid[i] = True
+    return seconds, valid
+
 def find_outgoing_link(node_id_from, links_map_from_node):
     """Encontra o ID de um link de saída do nó especificado."""
-    if node_id_from in links_map_from_node and links_map_from_node[node_id_from]:
-        return links_map_from_node[node_id_from][0]['id']
-    return "UNKNOWN_LINK"
+    return links_map_from_node.get(node_id_from, "UNKNOWN_LINK")
+
+def parse_activity_coords(activity_elem):
+    """
+    Extrai as coordenadas (x, y) de um elemento <activity>, ou None se ausentes ou inválidas.
+    Lê apenas os atributos necessários com .get(), sem copiar o mapa de atributos.
+    """
+    x_str = activity_elem.get('x')
+    y_str = activity_elem.get('y')
+    if x_str is None or y_str is None:
+        return None
+    try:
+        return (float(x_str), float(y_str))
+    except ValueError:
+        return None
+
+def parse_node_coords(x_strs, y_strs, node_ids):
+    """
+    Converte em lote as strings de coordenadas dos nós para um array float64 (N x 2).
+    Se alguma coordenada for inválida, converte nó a nó e descarta os nós inválidos.
+    Retorna (coordenadas, IDs dos nós mantidos).
+    """
+    node_coords = np.empty((len(node_ids), 2), dtype=np.float64)
+    try:
+        node_coords[:, 0] = np.array(x_strs, dtype=np.float64)
+        node_coords[:, 1] = np.array(y_strs, dtype=np.float64)
+        return node_coords, node_ids
+    except ValueError:
+        pass
+
+    kept = 0
+    kept_ids = []
+    for node_id, x_str, y_str in zip(node_ids, x_strs, y_strs):
+        try:
+            node_coords[kept] = (float(x_str), float(y_str))
+        except ValueError:
+            print(f"Aviso: Não foi possível converter coordenadas para o nó {node_id} (x='{x_str}', y='{y_str}'). Pulando nó.", file=sys.stderr)
+            continue
+        kept_ids.append(node_id)
+        kept += 1
+    return node_coords[:kept], kept_ids
 
 # --- Funções Principais (load_network_data, process_population) ---
 
@@ -34,53 +138,38 @@ def load_network_data(network_file_path):
     Lê o arquivo network.xml, extrai dados de nós, constrói uma KD-Tree
     para busca rápida de nós próximos, e extrai informações de links de saída.
     """
-    node_coords_list = [] # Lista de coordenadas [x, y] para construir a KD-Tree
-    node_id_map = []      # Lista de IDs de nós, correspondendo à ordem em node_coords_list
-    nodes_data_for_kdtree = {} # Para armazenar temporariamente {'id': id, 'x': x, 'y': y} antes de popular as listas
+    # Strings de coordenadas dos nós, convertidas em lote após o parsing
+    node_x_strs = []
+    node_y_strs = []
+    node_id_map = [] # Lista de IDs de nós, correspondendo à ordem das coordenadas
     
-    links_from_node_map = {}
+    links_from_node_map = {} # {id do nó de origem: id do primeiro link de saída}
 
     print(f"Iniciando o parsing do arquivo de rede: {network_file_path}", file=sys.stderr)
     try:
-        # Usar iterparse para o network.xml
-        context = ET.iterparse(network_file_path, events=('end',), tag='node')
+        # Um único iterparse para nós e links: evita ler e tokenizar o arquivo duas vezes
+        context = ET.iterparse(network_file_path, events=('end',), tag=('node', 'link'))
         for _, elem in context:
-            node_id = elem.get('id')
-            x_str = elem.get('x')
-            y_str = elem.get('y')
-            if node_id and x_str is not None and y_str is not None:
-                try:
-                    coord_x = float(x_str)
-                    coord_y = float(y_str)
-                    # Adiciona às listas para a KD-Tree
-                    node_coords_list.append([coord_x, coord_y])
+            if elem.tag == 'node':
+                node_id = elem.get('id')
+                x_str = elem.get('x')
+                y_str = elem.get('y')
+                if node_id and x_str is not None and y_str is not None:
+                    node_x_strs.append(x_str)
+                    node_y_strs.append(y_str)
                     node_id_map.append(node_id)
-                except ValueError:
-                    print(f"Aviso: Não foi possível converter coordenadas para o nó {node_id} (x='{x_str}', y='{y_str}'). Pulando nó.", file=sys.stderr)
-            elem.clear() # Limpa o elemento <node> da memória
-            # Remove o elemento do pai para economizar mais memória com lxml, se necessário
-            # while elem.getprevious() is not None:
-            #     del elem.getparent()[0]
-        
-        # Processar links (pode ser necessário um segundo parse ou carregar tudo se o arquivo não for gigante)
-        # Se o network.xml for muito grande, esta parte também precisaria de iterparse cuidadoso.
-        # Para simplificar, vamos assumir que a parte dos links pode ser processada de forma eficiente
-        # ou que o número de links não é o gargalo principal comparado ao iterparse da população.
-        # Uma abordagem mais robusta seria fazer dois passes ou usar iterparse com tags múltiplas.
-        
-        # Segundo iterparse para links (ou um parse completo se o arquivo de rede não for excessivamente grande)
-        context_links = ET.iterparse(network_file_path, events=('end',), tag='link')
-        for _, elem in context_links:
-            link_id = elem.get('id')
-            from_node = elem.get('from')
-            to_node = elem.get('to')
-            if link_id and from_node and to_node:
-                if from_node not in links_from_node_map:
-                    links_from_node_map[from_node] = []
-                links_from_node_map[from_node].append({'id': link_id, 'to': to_node})
-            elem.clear()
-            # while elem.getprevious() is not None:
-            #     del elem.getparent()[0]
+            else: # link
+                link_id = elem.get('id')
+                from_node = elem.get('from')
+                to_node = elem.get('to')
+                if link_id and from_node and to_node:
+                    # Apenas o primeiro link de saída de cada nó é utilizado
+                    if from_node not in links_from_node_map:
+                        links_from_node_map[from_node] = link_id
+            elem.clear() # Limpa o elemento <node>/<link> da memória
+            # Remove os irmãos já processados do pai para liberar memória com lxml
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
 
     except ET.XMLSyntaxError as e: # lxml usa XMLSyntaxError
         print(f"Erro de sintaxe no XML da rede: {e}", file=sys.stderr)
@@ -92,24 +181,187 @@ def load_network_data(network_file_path):
         print(f"Erro inesperado ao carregar a rede: {e}", file=sys.stderr)
         return None, None, None
 
-    if not node_coords_list:
+    node_coords, node_id_map = parse_node_coords(node_x_strs, node_y_strs, node_id_map)
+    del node_x_strs, node_y_strs
+
+    if not node_id_map:
         print("Nenhum nó encontrado no arquivo de rede.", file=sys.stderr)
         return None, None, None
         
     # Constrói a KD-Tree
     print("Construindo KD-Tree para os nós da rede...", file=sys.stderr)
-    node_kdtree = KDTree(np.array(node_coords_list))
+    # Construção rápida para uso único: divisão pelo ponto médio (sem ordenação por mediana),
+    # sem compactar os nós, folhas maiores e sem cópia do array de coordenadas.
+    # O array é float64, o tipo interno da cKDTree (outro tipo forçaria uma cópia).
+    # Entre nós equidistantes (coordenadas repetidas ou em grade), o nó escolhido depende da
+    # estrutura da árvore e pode diferir do de versões anteriores, com a mesma distância
+    kdtree_options = dict(leafsize=KDTREE_LEAF_SIZE, compact_nodes=False,
+                          balanced_tree=False, copy_data=False)
+    node_kdtree = cKDTree(node_coords, **kdtree_options)
+    # Reordena os nós na ordem interna da árvore e a reconstrói: os pontos de cada folha
+    # ficam contíguos na memória e a varredura das folhas durante as consultas é sequencial
+    tree_order = node_kdtree.indices
+    node_coords = node_coords[tree_order]
+    node_kdtree = cKDTree(node_coords, **kdtree_options)
+    # Array de objetos para permitir indexação vetorizada pelos índices da KD-Tree
+    node_id_map = np.array(node_id_map, dtype=object)[tree_order]
     print(f"KD-Tree construída. Rede carregada: {len(node_id_map)} nós.", file=sys.stderr)
     
     return node_kdtree, node_id_map, links_from_node_map
 
-def find_closest_node_kdtree(coord_x, coord_y, kdtree, node_id_map_list):
-    """Encontra o ID do nó mais próximo usando a KD-Tree."""
-    if kdtree is None:
+def morton_order(coords):
+    """
+    Retorna a permutação que ordena os pontos (array N x 2) pela curva Z (Morton),
+    calculada sobre uma grade de 2^16 x 2^16 células cobrindo a extensão dos pontos.
+    """
+    mins = coords.min(axis=0)
+    spans = coords.max(axis=0) - mins
+    spans[spans == 0] = 1
+    grid = ((coords - mins) / spans * 0xFFFF).astype(np.uint32)
+    # Espalha os 16 bits de cada eixo nas posições pares, para intercalar x e y
+    for shift, mask in ((8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333), (1, 0x55555555)):
+        grid = (grid | (grid << shift)) & mask
+    codes = grid[:, 0] | (grid[:, 1] << 1)
+    return np.argsort(codes, kind='stable')
+
+def estimate_distance_bound(coords, kdtree):
+    """
+    Estima o raio máximo de busca na KD-Tree: o percentil das distâncias ao nó mais próximo
+    em uma amostra de no máximo DISTANCE_BOUND_SAMPLE_SIZE pontos (e 1 a cada
+    DISTANCE_BOUND_MIN_STRIDE) do lote. Calculado uma vez e reutilizado nos lotes seguintes.
+    Retorna None (consulta sem limite) se o raio não for positivo e finito: a cKDTree trata o
+    limite como estrito, então um raio 0 (atividades sobre os nós) faria todo ponto ser
+    consultado duas vezes.
+    """
+    stride = max(DISTANCE_BOUND_MIN_STRIDE, len(coords) // DISTANCE_BOUND_SAMPLE_SIZE)
+    sample_distances, _ = kdtree.query(coords[::stride], workers=-1)
+    distance_bound = np.percentile(sample_distances, DISTANCE_BOUND_PERCENTILE)
+    if not (np.isfinite(distance_bound) and distance_bound > 0):
         return None
-    # A KDTree.query retorna (distância, índice)
-    distance, index = kdtree.query([coord_x, coord_y])
-    return node_id_map_list[index]
+    return distance_bound
+
+def find_closest_node_indices(coords, kdtree, distance_bound=None):
+    """
+    Encontra os índices (na ordem da KD-Tree) dos nós mais próximos para um lote
+    de coordenadas (array N x 2). Com distance_bound, a travessia da árvore é limitada
+    a esse raio e apenas os pontos sem nó dentro dele são consultados sem limite.
+    """
+    if len(coords) == 0:
+        return np.empty(0, dtype=np.intp)
+    # Coordenadas repetidas (casa/trabalho compartilhados, centróides de zonas) são consultadas uma vez.
+    # Cada par (x, y) é visto como um complex128 para deduplicar um array 1-D, bem mais rápido
+    # que np.unique(axis=0)
+    pairs = np.ascontiguousarray(coords, dtype=np.float64).view(np.complex128).ravel()
+    unique_pairs, inverse = np.unique(pairs, return_inverse=True)
+    coords = unique_pairs.view(np.float64).reshape(-1, 2)
+
+    # Consultas ordenadas pela curva Z: pontos vizinhos percorrem os mesmos ramos da árvore
+    order = morton_order(coords)
+    sorted_coords = coords[order]
+
+    # Uma única chamada em lote amortiza o custo Python/C por consulta;
+    # workers=-1 libera o GIL e usa todos os núcleos disponíveis.
+    if distance_bound is None:
+        distance_bound = np.inf
+    _, sorted_indices = kdtree.query(sorted_coords, distance_upper_bound=distance_bound, workers=-1)
+    # Pontos sem nó dentro do raio (índice == kdtree.n) são consultados novamente sem limite
+    misses = np.flatnonzero(sorted_indices == kdtree.n)
+    if len(misses):
+        _, sorted_indices[misses] = kdtree.query(sorted_coords[misses], workers=-1)
+
+    # Desfaz a permutação e a deduplicação para voltar à ordem original das coordenadas
+    indices = np.empty_like(sorted_indices)
+    indices[order] = sorted_indices
+    return indices[inverse]
+
+def extract_car_trips(item_kind, item_is_car, plan_starts):
+    """
+    Pareia, de forma vetorizada, cada perna de carro com a última atividade anterior
+    e a atividade imediatamente seguinte dentro do mesmo plano.
+    Retorna os índices (pernas, atividades de origem, atividades de destino) das viagens.
+    """
+    n_items = len(item_kind)
+    if n_items == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+
+    positions = np.arange(n_items)
+    is_activity = item_kind == ITEM_ACTIVITY
+    # Índice da última atividade até cada posição (-1 se nenhuma)
+    last_activity = np.where(is_activity, positions, -1)
+    np.maximum.accumulate(last_activity, out=last_activity)
+
+    plan_sizes = np.diff(plan_starts)
+    item_plan_start = np.repeat(plan_starts[:-1], plan_sizes)
+    item_plan_end = np.repeat(plan_starts[1:], plan_sizes)
+    next_is_activity = np.zeros(n_items, dtype=bool)
+    next_is_activity[:-1] = is_activity[1:]
+
+    is_trip = (
+        (item_kind == ITEM_LEG) & (item_is_car != 0)
+        & (last_activity >= item_plan_start)   # há atividade anterior no mesmo plano
+        & (positions + 1 < item_plan_end)      # o próximo item pertence ao mesmo plano
+        & next_is_activity
+    )
+    trip_legs = np.flatnonzero(is_trip)
+    return trip_legs, last_activity[trip_legs], trip_legs + 1
+
+def build_trip_batch(item_kind, item_x, item_y, item_is_car, item_time, plan_starts):
+    """
+    Converte os itens SoA de um lote de planos completos nas viagens de carro válidas.
+    Retorna (coordenadas das atividades M x 2, posições das origens e dos destinos nesse
+    array, segundos de partida), com uma entrada por viagem nos três últimos.
+    Os arrays de entrada são copiados, podendo ser reutilizados pelo chamador.
+    """
+    item_x = np.array(item_x, dtype=np.float64)
+    item_y = np.array(item_y, dtype=np.float64)
+    # Pareamento vetorizado perna -> atividades de origem e destino
+    trip_legs, trip_orig, trip_dest = extract_car_trips(
+        np.array(item_kind, dtype=np.int8),
+        np.array(item_is_car, dtype=np.int8),
+        np.array(plan_starts, dtype=np.int64),
+    )
+    # Descarta viagens cujas atividades não têm coordenadas válidas
+    has_coords = ~(np.isnan(item_x[trip_orig]) | np.isnan(item_y[trip_orig])
+                   | np.isnan(item_x[trip_dest]) | np.isnan(item_y[trip_dest]))
+    trip_legs, trip_orig, trip_dest = trip_legs[has_coords], trip_orig[has_coords], trip_dest[has_coords]
+    # Horário de partida: dep_time da perna ou, na falta dele, end_time da atividade anterior
+    trip_times = [item_time[leg] or item_time[orig] for leg, orig in zip(trip_legs.tolist(), trip_orig.tolist())]
+    # Viagens sem horário de partida válido são descartadas antes da consulta
+    start_seconds, valid = times_to_seconds(trip_times)
+    trip_orig, trip_dest = trip_orig[valid], trip_dest[valid]
+
+    # Cada atividade é consultada uma única vez, mesmo sendo destino de uma perna e origem da seguinte
+    is_used = np.zeros(len(item_x), dtype=bool)
+    is_used[trip_orig] = True
+    is_used[trip_dest] = True
+    activity_items = np.flatnonzero(is_used)
+    item_position = np.cumsum(is_used) - 1
+    activity_coords = np.column_stack((item_x[activity_items], item_y[activity_items]))
+    return activity_coords, item_position[trip_orig], item_position[trip_dest], start_seconds[valid]
+
+def run_pipeline_stage(process_batch, input_queue, output_queue, errors):
+    """
+    Etapa do pipeline: aplica process_batch a cada lote de input_queue e envia o resultado
+    para output_queue (se houver), até receber PIPELINE_END, que é repassado adiante.
+    Após um erro (registrado em errors), continua drenando a fila para não bloquear as
+    etapas anteriores.
+    """
+    while True:
+        batch = input_queue.get()
+        if batch is PIPELINE_END:
+            break
+        if errors:
+            continue
+        try:
+            result = process_batch(batch)
+        except Exception as e:
+            errors.append(e)
+            continue
+        if output_queue is not None:
+            output_queue.put(result)
+    if output_queue is not None:
+        output_queue.put(PIPELINE_END)
 
 def process_population(population_file_path, output_trips_file_path, 
                        node_kdtree, node_id_map_list, network_links_from_node):
@@ -117,127 +369,147 @@ def process_population(population_file_path, output_trips_file_path,
     Lê o arquivo population.xml de forma incremental, processa as viagens de carro,
     e escreve o arquivo trips.xml. Usa KD-Tree para busca de nós.
     """
-    if node_kdtree is None or not node_id_map_list:
+    if node_kdtree is None or node_id_map_list is None or len(node_id_map_list) == 0:
         print("Dados da KD-Tree da rede não carregados. Não é possível processar a população.", file=sys.stderr)
         return
 
     trip_counter = 0
     person_counter = 0
     
-    current_person_id = None
-    is_selected_plan = False
-    plan_items = [] # Armazena itens do plano atual (atividades, pernas)
+    # Itens (atividades e pernas) dos planos selecionados do lote atual, em arrays paralelos (SoA)
+    item_kind = array('b')    # ITEM_ACTIVITY ou ITEM_LEG
+    item_x = array('d')       # Coordenadas da atividade (NaN para pernas ou coordenadas inválidas)
+    item_y = array('d')
+    item_is_car = array('b')  # 1 se a perna tem modo 'car'
+    item_time = []            # end_time da atividade ou dep_time da perna
+    plan_starts = array('q', [0]) # Índice do primeiro item de cada plano (+ total no final)
+
+    # Pipeline: o parsing (thread principal) envia lotes de viagens para a consulta à KD-Tree,
+    # que envia os nós encontrados para a escrita. A consulta libera o GIL, então as três
+    # etapas se sobrepõem; as filas limitadas mantêm a memória sob controle.
+    query_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    write_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stage_errors = []
+
+    def submit_plan_items():
+        """Envia os itens acumulados para a consulta à KD-Tree e reinicia os arrays."""
+        if stage_errors:
+            raise stage_errors[0]
+        query_queue.put(build_trip_batch(item_kind, item_x, item_y, item_is_car, item_time, plan_starts))
+        for items in (item_kind, item_x, item_y, item_is_car, item_time):
+            del items[:]
+        del plan_starts[1:]
+
+    # IDs dos nós e de seus links de saída já codificados, na ordem da KD-Tree,
+    # para preencher TRIP_XML_TEMPLATE sem conversões por viagem
+    node_id_bytes = np.array([node_id.encode('utf-8') for node_id in node_id_map_list], dtype=object)
+    node_link_bytes = np.array([find_outgoing_link(node_id, network_links_from_node).encode('utf-8')
+                                for node_id in node_id_map_list], dtype=object)
+
+    # Raio de busca estimado no primeiro lote com amostra suficiente e reutilizado nos seguintes
+    # (None enquanto não estimado ou quando a estimativa não permite limitar a busca)
+    distance_bound = None
+    distance_bound_estimated = False
+
+    def query_batch(batch):
+        nonlocal distance_bound, distance_bound_estimated
+        activity_coords, orig_positions, dest_positions, start_seconds = batch
+        if (not distance_bound_estimated
+                and len(activity_coords) >= DISTANCE_BOUND_MIN_SAMPLE_SIZE * DISTANCE_BOUND_MIN_STRIDE):
+            distance_bound = estimate_distance_bound(activity_coords, node_kdtree)
+            distance_bound_estimated = True
+        activity_nodes = find_closest_node_indices(activity_coords, node_kdtree, distance_bound)
+        return activity_nodes[orig_positions], activity_nodes[dest_positions], start_seconds
+
+    def write_batch(batch):
+        nonlocal trip_counter
+        origin_nodes, destination_nodes, start_seconds = batch
+        first_trip = trip_counter + 1
+        trip_counter += len(start_seconds)
+        trip_lines = [
+            TRIP_XML_TEMPLATE % fields for fields in zip(
+                range(first_trip, trip_counter + 1),
+                node_id_bytes[origin_nodes].tolist(),
+                node_id_bytes[destination_nodes].tolist(),
+                node_link_bytes[origin_nodes].tolist(),
+                start_seconds.tolist(),
+            )
+        ]
+        for block_start in range(0, len(trip_lines), TRIPS_PER_WRITE):
+            outfile.write(b''.join(trip_lines[block_start:block_start + TRIPS_PER_WRITE]))
     
     print(f"Iniciando processamento da população de {population_file_path}...", file=sys.stderr)
     try:
-        with open(output_trips_file_path, 'w', encoding='utf-8') as outfile:
-            outfile.write("<scsimulator_matrix>\n")
-
-            # iterparse para processamento incremental com lxml
-            # Focamos nos eventos 'end' para processar os elementos depois de completos
-            context = ET.iterparse(population_file_path, events=('start', 'end')) 
-            
-            for event, elem in context:
-                if event == 'start':
-                    if elem.tag == 'person':
-                        current_person_id = elem.get('id')
-                        person_counter += 1
-                        if person_counter % 100000 == 0:
-                            print(f"Processando pessoa {person_counter} (ID: {current_person_id})", file=sys.stderr)
-                    elif elem.tag == 'plan' and current_person_id is not None:
-                        if elem.get('selected') == 'yes':
-                            is_selected_plan = True
-                            plan_items = [] # Reinicia para este plano
-                        else:
-                            is_selected_plan = False
+        # Saída binária com buffer grande; as viagens são escritas em blocos
+        with open(output_trips_file_path, 'wb', buffering=OUTPUT_BUFFER_SIZE) as outfile:
+            outfile.write(b"<scsimulator_matrix>\n")
+
+            query_thread = threading.Thread(target=run_pipeline_stage,
+                                            args=(query_batch, query_queue, write_queue, stage_errors),
+                                            daemon=True)
+            write_thread = threading.Thread(target=run_pipeline_stage,
+                                            args=(write_batch, write_queue, None, stage_errors),
+                                            daemon=True)
+            query_thread.start()
+            write_thread.start()
+            try:
+                # iterparse com lxml apenas sobre <plan> e <person> completos: as atividades
+                # e pernas são percorridas diretamente nos filhos do plano, sem eventos próprios
+                context = ET.iterparse(population_file_path, events=('end',), tag=('plan', 'person'))
                 
-                elif event == 'end': # Processar no 'end' para ter o elemento completo
-                    if is_selected_plan:
-                        if elem.tag == 'activity':
-                            act_x_str = elem.get('x')
-                            act_y_str = elem.get('y')
-                            act_end_time = elem.get('end_time')
-                            act_type = elem.get('type')
-
-                            current_activity_coords = None
-                            if act_x_str is not None and act_y_str is not None:
-                                try:
-                                    current_activity_coords = (float(act_x_str), float(act_y_str))
-                                except ValueError:
-                                    pass # Coordenadas inválidas, será tratado depois
-                            
-                            plan_items.append({
-                                'type': 'activity',
-                                'details': {
-                                    'coords': current_activity_coords,
-                                    'end_time': act_end_time,
-                                    'activity_type': act_type 
-                                }
-                            })
-                        elif elem.tag == 'leg':
-                            # Coleta todos os atributos da perna
-                            plan_items.append({'type': 'leg', 'attrs': dict(elem.attrib)})
-
-                    if elem.tag == 'plan' and current_person_id is not None:
-                        if is_selected_plan:
-                            activity_before_leg_details = None
-                            for i, item in enumerate(plan_items):
-                                if item['type'] == 'activity':
-                                    activity_before_leg_details = item['details']
-                                elif item['type'] == 'leg' and activity_before_leg_details is not None:
-                                    leg_attrs = item['attrs']
-                                    if leg_attrs.get('mode') == 'car':
-                                        if (i + 1) < len(plan_items) and plan_items[i+1]['type'] == 'activity':
-                                            activity_after_leg_details = plan_items[i+1]['details']
-                                            
-                                            if activity_before_leg_details['coords'] and activity_after_leg_details['coords']:
-                                                start_time_str = leg_attrs.get('dep_time')
-                                                if not start_time_str:
-                                                    start_time_str = activity_before_leg_details.get('end_time')
-                                                
-                                                start_seconds = time_to_seconds(start_time_str)
-
-                                                if start_seconds is not None:
-                                                    orig_x, orig_y = activity_before_leg_details['coords']
-                                                    dest_x, dest_y = activity_after_leg_details['coords']
-
-                                                    # Usa KD-Tree para encontrar nós próximos
-                                                    origin_node_id = find_closest_node_kdtree(orig_x, orig_y, node_kdtree, node_id_map_list)
-                                                    destination_node_id = find_closest_node_kdtree(dest_x, dest_y, node_kdtree, node_id_map_list)
-
-                                                    if origin_node_id and destination_node_id:
-                                                        link_origin_id = find_outgoing_link(origin_node_id, network_links_from_node)
-                                                        
-                                                        trip_counter += 1
-                                                        trip_name = f"t{trip_counter}"
-                                                        
-                                                        trip_xml_str = (
-                                                            f'  <trip name="{trip_name}" '
-                                                            f'origin="{origin_node_id}" '
-                                                            f'destination="{destination_node_id}" '
-                                                            f'link_origin="{link_origin_id}" '
-                                                            f'count="1" '
-                                                            f'start="{start_seconds}" '
-                                                            f'mode="car" '
-                                                            f'digital_rails_capable="false"/>\n'
-                                                        )
-                                                        outfile.write(trip_xml_str)
-                        # Limpeza após processar o plano
-                        is_selected_plan = False
-                        plan_items = []
+                for _, elem in context:
+                    if elem.tag == 'plan':
+                        if elem.get('selected') == 'yes':
+                            for child in elem.iterchildren('activity', 'leg'):
+                                if child.tag == 'activity':
+                                    coords = parse_activity_coords(child) or (NAN, NAN)
+                                    item_kind.append(ITEM_ACTIVITY)
+                                    item_x.append(coords[0])
+                                    item_y.append(coords[1])
+                                    item_is_car.append(0)
+                                    item_time.append(child.get('end_time'))
+                                else:
+                                    item_kind.append(ITEM_LEG)
+                                    item_x.append(NAN)
+                                    item_y.append(NAN)
+                                    item_is_car.append(child.get('mode') == 'car')
+                                    item_time.append(child.get('dep_time'))
+                            plan_starts.append(len(item_kind))
+                            # Os lotes são fechados sempre entre planos completos
+                            if len(item_kind) >= PLAN_ITEMS_PER_BATCH:
+                                submit_plan_items()
+                        # Planos não selecionados são descartados sem percorrer os filhos
                         elem.clear()
-                        # Para lxml, também é bom remover o elemento do pai para garantir a liberação de memória
-                        # Se elem.getparent() não for None:
-                        #    elem.getparent().remove(elem)
-                        # Contudo, iterparse com elem.clear() é geralmente o principal.
+                        # Remove também os irmãos anteriores (planos já processados, atributos da pessoa)
+                        while elem.getprevious() is not None:
+                            del elem.getparent()[0]
 
-                    elif elem.tag == 'person':
-                        current_person_id = None # Reseta
+                    else: # person
+                        person_counter += 1
+                        if person_counter % 100000 == 0:
+                            print(f"Processando pessoa {person_counter} (ID: {elem.get('id')})", file=sys.stderr)
                         elem.clear()
-                        # if elem.getparent() is not None:
-                        #    elem.getparent().remove(elem)
-            
-            outfile.write("</scsimulator_matrix>\n")
+                        # Remove as pessoas já processadas do pai para liberar memória com lxml
+                        while elem.getprevious() is not None:
+                            del elem.getparent()[0]
+
+                if len(item_kind):
+                    submit_plan_items()
+            except ET.XMLSyntaxError:
+                # Como no processamento em fluxo, as viagens dos planos completos lidos
+                # antes do erro ainda são escritas
+                if len(item_kind):
+                    submit_plan_items()
+                raise
+            finally:
+                # Encerra o pipeline mesmo em caso de erro no parsing
+                query_queue.put(PIPELINE_END)
+                query_thread.join()
+                write_thread.join()
+            if stage_errors:
+                raise stage_errors[0]
+
+            outfile.write(b"</scsimulator_matrix>\n")
             sys.stdout.flush()
             sys.stderr.flush()
             print(f"\nProcessamento concluído. Geradas {trip_counter} viagens para {person_counter} pessoas.", file=sys.stderr)